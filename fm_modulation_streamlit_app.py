@@ -1,5 +1,6 @@
-import io
-import wave
+import random
+import struct
+from fractions import Fraction
 from textwrap import dedent
 
 import numpy as np
@@ -41,6 +42,14 @@ ear = st.radio(
     help="CFTと同様に、FM刺激を両耳・左耳のみ・右耳のみのいずれかに出力します。",
 )
 
+# 音質（既定は16-bitリニアPCM）
+mulaw = st.toggle(
+    "軽量モード（8-bit µ-law）",
+    value=False,
+    help="WAVを8-bit µ-law で作成し、ブラウザへ送るデータ量を半分にします。"
+    "通信が遅い環境向けです。ブラウザによっては再生できない場合があります。",
+)
+
 st.markdown("### FM周波数（推奨設定＋任意変更）")
 
 # 初期値を 2 Hz にしておく
@@ -108,61 +117,239 @@ st.markdown(
 )
 
 
-def generate_fm_tone(
+def _oscillator(step: float, n_samples: int, dtype: type) -> np.ndarray:
+    """
+    exp(i * step * k)（k = 0 … n_samples-1）を倍々生成で返す。
+    すでに埋まった先頭ブロックに exp(i * step * m) を掛けて次のブロックを作るので、
+    超越関数の評価は O(log n) 回で済み、残りは複素数の掛け算だけになる。
+    各段の回転子は直接計算するため、誤差も log n 程度しか蓄積しない。
+    """
+    out = np.empty(n_samples, dtype=dtype)
+    out[0] = 1
+    filled = 1
+    while filled < n_samples:
+        block = min(filled, n_samples - filled)
+        rotator = dtype(np.exp(1j * step * filled))
+        np.multiply(out[:block], rotator, out=out[filled : filled + block])
+        filled += block
+    return out
+
+
+@st.cache_resource(show_spinner=False, max_entries=4)
+def _time_axis(sr: int, n_samples: int) -> np.ndarray:
+    """
+    時間軸 t = n / sr（秒）を返す。sr と音の長さが同じ間は同じ配列を使い回すので、
+    書き換えられないよう読み取り専用にしておく。
+    """
+    t = np.arange(n_samples) / sr
+    t.setflags(write=False)
+    return t
+
+
+def _fm_phase(
+    sr: int,
+    freq: float,
+    fm_hz: float,
+    depth: float,
+    n_samples: int,
+) -> np.ndarray:
+    """
+    FM音の位相φ(t)を [0, 2π) に畳んだ float64 配列で返す。
+    φ(t) は数秒で 10^5 rad 程度まで増えるので、畳むまでは float64 で扱う
+    （float32 のままだと 10^-2 rad 程度の位相誤差になる）。以降の処理は float32。
+    """
+    # 周波数変調：f(t) = f_c * (1 + depth * sin(2π f_m t))
+    # 位相φ(t) = 2π ∫ f(t) dt は閉形式で書ける（cumsumによる数値積分は不要）
+    #   φ(t) = 2π f_c t + (f_c * depth / f_m) * (1 - cos(2π f_m t))
+    # cos(2π f_m t) は純粋な正弦波なので倍々生成で求める
+    t = _time_axis(sr, n_samples)
+    mod = _oscillator(2 * np.pi * fm_hz / sr, n_samples, np.complex128).real
+    np.subtract(1, mod, out=mod)
+    mod *= freq * depth / fm_hz
+    phase = np.multiply(t, 2 * np.pi * freq)
+    phase += mod
+    np.remainder(phase, 2 * np.pi, out=phase)
+    return phase
+
+
+def _fm_period_samples(sr: int, fm_hz: float) -> int:
+    """
+    変調項 cos(2π f_m n / sr) がちょうど繰り返す最小のサンプル数を返す。
+    sr / f_m が（分母の小さい）有理数にならない場合は 0。
+    """
+    fm = Fraction(fm_hz).limit_denominator(1000)
+    if abs(float(fm) - fm_hz) > 1e-9:
+        return 0
+    # sr / f_m = p / q（既約）なら、q 周期 = p サンプルで整数になる
+    return (Fraction(sr) / fm).numerator
+
+
+@st.cache_data(show_spinner=False, max_entries=64, ttl=3600)
+def _mono_tone(
     sr: int,
     freq: float,
     dur_ms: int,
     fm_hz: float,
     depth: float,
     with_fm: bool,
-    ear: str,
-) -> bytes:
+) -> np.ndarray:
     """
-    FMあり／なしの単音を生成して16-bit WAVバイト列を返す。
-    ear: "両耳" / "左耳のみ" / "右耳のみ"
+    FMあり／なしの単音（16-bit整数, モノラル）を生成する。
+    耳条件に依存しないので、両耳 / 左耳のみ / 右耳のみ で共有してキャッシュする。
     """
     n_samples = int(sr * dur_ms / 1000)
     if n_samples <= 0:
         n_samples = 1
 
-    t = np.linspace(0, dur_ms / 1000, n_samples, endpoint=False)
+    if with_fm and fm_hz > 0:
+        period = _fm_period_samples(sr, fm_hz)
+        if 0 < period <= n_samples // 2:
+            # 変調項は period サンプルごとに厳密に繰り返すので、1周期ぶんだけ合成して並べる。
+            # 周期ごとにキャリア位相が 2π f_c period / sr 進む分は、回転子を掛けて補正する
+            tile = _fm_phase(sr, freq, fm_hz, depth, period).astype(np.float32)
+            tile = np.exp(1j * tile)  # complex64 のまま評価される
+            n_tiles = -(-n_samples // period)
+            shift = _oscillator(2 * np.pi * freq * period / sr, n_tiles, np.complex64)
+            audio = (shift[:, None] * tile).imag.ravel()[:n_samples]
+        else:
+            # 位相はfloat64で計算し [0, 2π) に畳んでから float32 に落とす
+            # （長い音でも位相精度を保ちつつ、sin は float32 の SIMD 経路で評価する）
+            audio = _fm_phase(sr, freq, fm_hz, depth, n_samples).astype(np.float32)
+            np.sin(audio, out=audio)
+    else:
+        # FMなしは純音そのものなので、sin を呼ばずに倍々生成で作る
+        audio = _oscillator(2 * np.pi * freq / sr, n_samples, np.complex64).imag.copy()
+
+    # 0.8で適当に音量を調整し、切り捨てではなく四捨五入で16-bit整数に
+    # （切り捨てだと約0.5 LSBの直流オフセットが乗る）
+    np.multiply(audio, np.float32(0.8 * 32767), out=audio)
+    np.rint(audio, out=audio)
+    return audio.astype(np.int16)
+
+
+@st.cache_resource(show_spinner=False)
+def _mulaw_table() -> np.ndarray:
+    """
+    16-bit リニアPCM → 8-bit µ-law（G.711）の変換表を返す。
+    int16 のサンプルを uint16 として見たビット列で引く（65536 エントリ）。
+    """
+    # CCITT G.711 の参照実装（Sun g711.c / audioop.lin2ulaw）と同じく14-bitに落としてから符号化
+    x = np.arange(65536, dtype=np.uint16).view(np.int16).astype(np.int32) >> 2
+    mask = np.where(x < 0, 0x7F, 0xFF)
+    mag = np.minimum(np.abs(x) + 0x21, 0x1FFF)  # バイアスを足して上限でクリップ
+    exponent = np.frexp(mag)[1] - 6  # mag は [33, 8191] なので 0〜7
+    mantissa = (mag >> (exponent + 1)) & 0x0F
+    table = ((exponent << 4) | mantissa) ^ mask
+    table = table.astype(np.uint8)
+    table.setflags(write=False)
+    return table
+
+
+# µ-law で振幅0（無音）を表すバイト
+MULAW_SILENCE = 0xFF
 
-    if with_fm:
-        # 周波数変調：f(t) = f_c * (1 + depth * sin(2π f_m t))
-        # 位相φ(t) = 2π ∫ f(t) dt を数値積分で近似
-        freq_inst = freq * (1 + depth * np.sin(2 * np.pi * fm_hz * t))
-        phase = 2 * np.pi * np.cumsum(freq_inst) / sr
-        audio = np.sin(phase)
+
+def _wav_buffer(sr: int, n_frames: int, mulaw: bool = False) -> tuple[bytearray, np.ndarray]:
+    """
+    ステレオWAV全体ぶんのバッファを確保し、先頭にRIFFヘッダを書き込む。
+    mulaw=False なら 16-bit リニアPCM、True なら 8-bit µ-law（fmt + fact チャンク付き）。
+    戻り値の (n_frames, 2) 配列はヘッダ直後のサンプル領域そのもの（コピーではない）なので、
+    ここに書き込めばそのままWAVになる。サンプル領域はゼロで初期化されている
+    （リニアPCMでは無音だが、µ-law の無音は MULAW_SILENCE）。
+    """
+    n_channels = 2
+    sampwidth = 1 if mulaw else 2  # 8-bit µ-law / 16-bit PCM
+    block_align = n_channels * sampwidth
+    data_size = n_frames * block_align
+
+    if mulaw:
+        # 非PCM形式なので fmt チャンクに cbSize を付け、fact チャンク（サンプル数）を置く
+        header_format = "<4sI4s4sIHHIIHHH4sII4sI"
+        fmt_fields = (b"fmt ", 18, 7, n_channels, sr, sr * block_align, block_align, 8, 0)
+        fmt_fields += (b"fact", 4, n_frames)
     else:
-        audio = np.sin(2 * np.pi * freq * t)
-
-    # 0.8で適当に音量を調整して16-bit整数に
-    audio = (0.8 * audio * 32767).astype(np.int16)
-
-    # ステレオ化：耳条件に応じて L/R を振り分け
-    if ear == "左耳のみ":
-        left = audio
-        right = np.zeros_like(audio)
-    elif ear == "右耳のみ":
-        left = np.zeros_like(audio)
-        right = audio
-    else:  # 両耳
-        left = audio
-        right = audio
-
-    # L/Rをインターリーブしてステレオ配列に
-    stereo = np.empty(2 * len(audio), dtype=np.int16)
-    stereo[0::2] = left
-    stereo[1::2] = right
-
-    # WAVに書き出してバイナリとして返す
-    buf = io.BytesIO()
-    with wave.open(buf, "wb") as wf:
-        wf.setnchannels(2)
-        wf.setsampwidth(2)  # 16-bit
-        wf.setframerate(sr)
-        wf.writeframes(stereo.tobytes())
-    return buf.getvalue()
+        header_format = "<4sI4s4sIHHIIHH4sI"
+        fmt_fields = (b"fmt ", 16, 1, n_channels, sr, sr * block_align, block_align, 16)
+    header_size = struct.calcsize(header_format)
+
+    buf = bytearray(header_size + data_size)
+    struct.pack_into(
+        header_format,
+        buf,
+        0,
+        b"RIFF",
+        header_size - 8 + data_size,
+        b"WAVE",
+        *fmt_fields,
+        b"data",
+        data_size,
+    )
+    samples = np.frombuffer(
+        buf, dtype=np.uint8 if mulaw else np.int16, offset=header_size
+    ).reshape(n_frames, n_channels)
+    return buf, samples
+
+
+@st.cache_data(show_spinner=False, max_entries=64, ttl=3600)
+def generate_fm_tone(
+    sr: int,
+    freq: float,
+    dur_ms: int,
+    fm_hz: float,
+    depth: float,
+    with_fm: bool,
+    ear: str,
+    mulaw: bool = False,
+) -> bytes:
+    """
+    FMあり／なしの単音を生成してWAVバイト列を返す。
+    ear: "両耳" / "左耳のみ" / "右耳のみ"
+    mulaw: True なら 8-bit µ-law、False なら 16-bit リニアPCM
+
+    同じパラメータでの再生（ランダムボタンの連打など）はキャッシュから返す。
+    """
+    audio = _mono_tone(sr, freq, dur_ms, fm_hz, depth, with_fm)
+
+    if mulaw:
+        audio = _mulaw_table()[audio.view(np.uint16)]
+
+    # ステレオ化：WAVバッファのサンプル領域を (n, 2) 配列として直接埋める
+    # （C連続の (n, 2) は LRLR… のインターリーブと同じメモリ配置）
+    buf, stereo = _wav_buffer(sr, len(audio), mulaw)
+    if ear in ("左耳のみ", "右耳のみ"):
+        # 片耳：該当チャネル（L=0 / R=1）だけに書き込む。
+        # リニアPCMはゼロ初期化のままで無音になるが、µ-law は無音の値で埋める
+        channel = 0 if ear == "左耳のみ" else 1
+        stereo[:, channel] = audio
+        if mulaw:
+            stereo[:, 1 - channel] = MULAW_SILENCE
+    else:  # 両耳：L/R 両方へ1回のブロードキャスト代入で書き込む
+        stereo[:] = audio[:, None]
+
+    return bytes(buf)
+
+
+@st.cache_data(show_spinner=False, max_entries=32, ttl=3600)
+def _make_both(
+    sr: int,
+    freq: float,
+    dur_ms: int,
+    fm_hz: float,
+    depth: float,
+    ear: str,
+    mulaw: bool,
+) -> tuple[bytes, bytes]:
+    """
+    (FMなし, FMあり) のWAVバイト列をまとめて返す。
+    パラメータが変わった時点で両方を用意しておき、どのボタンも生成待ちなしで再生できるようにする。
+    """
+    wav_no_fm = generate_fm_tone(
+        sr, freq, dur_ms, fm_hz, depth, with_fm=False, ear=ear, mulaw=mulaw
+    )
+    wav_fm = generate_fm_tone(
+        sr, freq, dur_ms, fm_hz, depth, with_fm=True, ear=ear, mulaw=mulaw
+    )
+    return wav_no_fm, wav_fm
 
 
 st.markdown("### ▶️ 刺激の再生")
@@ -181,32 +368,47 @@ st.write(
     )
 )
 
-col1, col2, col3 = st.columns(3)
-
 if "last_random_label" not in st.session_state:
     st.session_state["last_random_label"] = "（まだ未実施）"
 
-with col1:
-    if st.button("🎵 FMなし（フラット）"):
-        wav_bytes = generate_fm_tone(sr, freq, dur_ms, fm_hz, depth, with_fm=False, ear=ear)
-        st.audio(wav_bytes, format="audio/wav", autoplay=True)
 
-with col2:
-    if st.button("🎵 FMあり（変調）"):
-        wav_bytes = generate_fm_tone(sr, freq, dur_ms, fm_hz, depth, with_fm=True, ear=ear)
-        st.audio(wav_bytes, format="audio/wav", autoplay=True)
+@st.fragment
+def playback_buttons(
+    sr: int,
+    freq: float,
+    dur_ms: int,
+    fm_hz: float,
+    depth: float,
+    ear: str,
+    mulaw: bool,
+) -> None:
+    """
+    再生ボタン3つとランダム刺激のメモ。
+    フラグメントにしておくことで、ボタンを押してもこの部分だけが再実行される。
+    """
+    wav_no_fm, wav_fm = _make_both(sr, freq, dur_ms, fm_hz, depth, ear, mulaw)
+
+    col1, col2, col3 = st.columns(3)
+
+    with col1:
+        if st.button("🎵 FMなし（フラット）"):
+            st.audio(wav_no_fm, format="audio/wav", autoplay=True)
+
+    with col2:
+        if st.button("🎵 FMあり（変調）"):
+            st.audio(wav_fm, format="audio/wav", autoplay=True)
+
+    with col3:
+        if st.button("🎲 ランダム（一発）"):
+            with_fm = bool(random.getrandbits(1))
+            label = "FMあり" if with_fm else "FMなし"
+            st.session_state["last_random_label"] = label
+            st.audio(wav_fm if with_fm else wav_no_fm, format="audio/wav", autoplay=True)
 
-with col3:
-    if st.button("🎲 ランダム（一発）"):
-        import random
+    st.info(f"直近のランダム刺激：**{st.session_state['last_random_label']}**（検査者用メモ）")
 
-        with_fm = bool(random.getrandbits(1))
-        label = "FMあり" if with_fm else "FMなし"
-        st.session_state["last_random_label"] = label
-        wav_bytes = generate_fm_tone(sr, freq, dur_ms, fm_hz, depth, with_fm=with_fm, ear=ear)
-        st.audio(wav_bytes, format="audio/wav", autoplay=True)
 
-st.info(f"直近のランダム刺激：**{st.session_state['last_random_label']}**（検査者用メモ）")
+playback_buttons(sr, freq, dur_ms, fm_hz, depth, ear, mulaw)
 
 st.markdown(
     """